@@ -1,14 +1,21 @@
 from __future__ import annotations
 
-import json
+import functools
+import io
 import re
 import shutil
-import subprocess
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import cycle
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
+import orjson
 import streamlit as st
-from pdf2image import convert_from_path
+
+if TYPE_CHECKING:
+    import fitz
 
 
 BASE_DIR = Path(__file__).resolve().parent
@@ -18,6 +25,25 @@ DATA_DIR = LOCAL_DATA_DIR if LOCAL_DATA_DIR.exists() else REPO_DATA_DIR
 RESULTS_DIR = DATA_DIR / "results"
 PDF_DIR = DATA_DIR / "pdfs"
 
+@st.cache_resource(show_spinner=False)
+def _executor() -> ThreadPoolExecutor:
+    # Streamlit rebuilds module globals on every script rerun; cache_resource
+    # keeps one pool per process instead of leaking a fresh pool (and its
+    # workers) per interaction.
+    return ThreadPoolExecutor(max_workers=2)
+
+@st.cache_resource(show_spinner=False)
+def _fitz_lock() -> threading.Lock:
+    # PyMuPDF is not thread-safe and _open_doc shares one handle per PDF
+    # across the prefetch workers and all script threads, so every fitz call
+    # must serialize on one process-wide lock. A module global would be a
+    # fresh Lock object on each rerun and guard nothing.
+    return threading.Lock()
+
+_ISO_DURATION_RE = re.compile(r"P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)W)?(?:(\d+)D)?")
+_SECTION_41_RE = re.compile(r"\b4[.,]1\b", re.IGNORECASE)
+_INTERVAL_UNIT_RU = {"DAY": "день", "WEEK": "неделя", "MONTH": "месяц", "YEAR": "год"}
+
 KEY_LABELS_RU = {
     "indications": "Показания",
     "dosage": "Схемы дозирования",
@@ -50,9 +76,16 @@ KEY_LABELS_RU = {
     "form": "Лекарственная форма",
 }
 
+# Label fragments for render_scalar_line, formatted once at import time.
+_LABEL_HTML = {k: f"<span class='dense-key'>{v}:</span>" for k, v in KEY_LABELS_RU.items()}
+
+# Keys humanize_value actually handles; everything else skips the call.
+_HUMANIZE_KEYS = frozenset({"courseDurationMin", "courseDurationMax", "courseDuration", "intervalUnit"})
+_VALUE_CLASS = {"schemaDescription": "dense-value-regular"}
+
 
 def humanize_iso_duration(value: str) -> str:
-    m = re.fullmatch(r"P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)W)?(?:(\d+)D)?", value.strip())
+    m = _ISO_DURATION_RE.fullmatch(value.strip())
     if not m:
         return value
     years = int(m.group(1) or 0)
@@ -72,12 +105,10 @@ def humanize_iso_duration(value: str) -> str:
 
 
 def humanize_value(key: str, value: Any) -> Any:
-    if isinstance(value, str) and key in {"courseDurationMin", "courseDurationMax", "courseDuration"}:
-        # Keep exact ISO value from JSON (e.g., P83D) without rounding/conversion.
-        return value
+    # Callers gate on _HUMANIZE_KEYS. Course durations keep the exact ISO
+    # value from JSON (e.g., P83D) without rounding/conversion.
     if key == "intervalUnit":
-        mapping = {"DAY": "день", "WEEK": "неделя", "MONTH": "месяц", "YEAR": "год"}
-        return mapping.get(str(value), value)
+        return _INTERVAL_UNIT_RU.get(str(value), value)
     return value
 
 
@@ -85,11 +116,12 @@ def humanize_value(key: str, value: Any) -> Any:
 def list_result_files() -> list[str]:
     if not RESULTS_DIR.exists():
         return []
-    files = sorted([p.name for p in RESULTS_DIR.glob("*.json") if not p.name.startswith("_")])
+    files = sorted(p.name for p in RESULTS_DIR.iterdir() if p.suffix == ".json" and not p.name.startswith("_"))
+    needle = "преднизолон"
     filtered: list[str] = []
     prednisolone_kept = False
     for name in files:
-        if "преднизолон" in name.lower():
+        if needle in name.casefold():
             if prednisolone_kept:
                 continue
             prednisolone_kept = True
@@ -99,122 +131,123 @@ def list_result_files() -> list[str]:
 
 @st.cache_data(show_spinner=False)
 def load_json(path: str) -> Any:
-    return json.loads(Path(path).read_text(encoding="utf-8"))
+    return orjson.loads(Path(path).read_bytes())
 
 
 def label_ru(key: str) -> str:
     return KEY_LABELS_RU.get(key, key)
 
 
-def render_scalar_line(key: str, value: Any) -> None:
+def render_scalar_line(key: str, value: Any) -> str:
     if value is None:
-        return
+        return ""
     if isinstance(value, str) and not value.strip():
-        return
+        return ""
     if key == "tags":
-        render_tags(str(value))
-        return
-    value = humanize_value(key, value)
-    value_class = "dense-value"
-    if key == "schemaDescription":
-        value_class = "dense-value-regular"
-    st.markdown(
-        (
-            "<div class='dense-line'>"
-            f"<span class='dense-key'>{label_ru(key)}:</span> <span class='{value_class}'>{value}</span>"
-            "</div>"
-        ),
-        unsafe_allow_html=True,
-    )
+        return render_tags(str(value))
+    if key in _HUMANIZE_KEYS:
+        value = humanize_value(key, value)
+    value_class = _VALUE_CLASS.get(key, "dense-value")
+    label_html = _LABEL_HTML.get(key) or f"<span class='dense-key'>{key}:</span>"
+    return f"<div class='dense-line'>{label_html} <span class='{value_class}'>{value}</span></div>"
 
 
-def render_tags(raw_tags: str) -> None:
+def render_tags(raw_tags: str) -> str:
     parts = [p.strip() for p in raw_tags.split(";") if p.strip()]
     if not parts:
-        return
-    html_parts = []
+        return ""
     palette = ["#E3F2FD", "#E8F5E9", "#FFF3E0", "#F3E5F5", "#E0F7FA"]
-    for idx, part in enumerate(parts):
-        bg = palette[idx % len(palette)]
-        html_parts.append(
-            f"<span style='background:{bg}; color:#111111; padding:4px 8px; border-radius:6px; "
-            f"margin-right:6px; display:inline-block; margin-bottom:6px;'>{part}</span>"
-        )
-    st.markdown(f"**{label_ru('tags')}:**  " + "".join(html_parts), unsafe_allow_html=True)
-
-
-def open_block(title: str) -> None:
-    st.markdown(
-        (
-            "<div style='border:1px solid #d9d9d9; border-radius:10px; "
-            "padding:8px 10px; margin:6px 0; background:#fafafa;'>"
-            f"<div style='font-weight:700; margin-bottom:4px; line-height:1.05; color:#111111;'>{title}</div>"
-        ),
-        unsafe_allow_html=True,
+    spans = [
+        f"<span style='background:{bg}; color:#111111; padding:4px 8px; border-radius:6px; "
+        f"margin-right:6px; display:inline-block; margin-bottom:6px;'>{part}</span>"
+        for part, bg in zip(parts, cycle(palette))
+    ]
+    return "".join([f"<div class='dense-line'><b>{label_ru('tags')}:</b>  ", *spans, "</div>"])
+
+
+def open_block(title: str) -> str:
+    return (
+        "<div style='border:1px solid #d9d9d9; border-radius:10px; "
+        "padding:8px 10px; margin:6px 0; background:#fafafa;'>"
+        f"<div style='font-weight:700; margin-bottom:4px; line-height:1.05; color:#111111;'>{title}</div>"
     )
 
 
-def open_block_soft(title: str) -> None:
-    st.markdown(
-        (
-            "<div style='border:1px solid #d9d9d9; border-radius:10px; "
-            "padding:8px 10px; margin:6px 0; background:#f5f8ff;'>"
-            f"<div style='font-weight:700; margin-bottom:4px; line-height:1.05; color:#111111;'>{title}</div>"
-        ),
-        unsafe_allow_html=True,
+def open_block_soft(title: str) -> str:
+    return (
+        "<div style='border:1px solid #d9d9d9; border-radius:10px; "
+        "padding:8px 10px; margin:6px 0; background:#f5f8ff;'>"
+        f"<div style='font-weight:700; margin-bottom:4px; line-height:1.05; color:#111111;'>{title}</div>"
     )
 
 
-def close_block() -> None:
-    st.markdown("</div>", unsafe_allow_html=True)
-
-
-def render_structured(data: Any, level: int = 0, parent_key: str = "") -> None:
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if isinstance(value, dict):
-                if key != "indication":
-                    if key == "administration":
-                        open_block_soft(label_ru(key))
-                        render_structured(value, level + 1, key)
-                        close_block()
+def close_block() -> str:
+    return "</div>"
+
+
+def render_structured(data: Any, buf: list[str], level: int = 0, parent_key: str = "") -> None:
+    # Iterative walk over an explicit stack: each node expands into a flat
+    # run of ("html", fragment) / ("node", child, ...) frames, so deeply
+    # nested JSON costs no Python call frames and cannot hit the recursion
+    # limit. Frames are pushed in reverse to keep document order.
+    stack: deque[tuple[Any, ...]] = deque([("node", data, level, parent_key)])
+    while stack:
+        frame = stack.pop()
+        if frame[0] == "html":
+            buf.append(frame[1])
+            continue
+        _, node, lvl, pk = frame
+        frames: list[tuple[Any, ...]] = []
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if isinstance(value, dict):
+                    if key != "indication":
+                        if key == "administration":
+                            frames.append(("html", open_block_soft(label_ru(key))))
+                            frames.append(("node", value, lvl + 1, key))
+                            frames.append(("html", close_block()))
+                            continue
+                        frames.append(("html", f"<div class='dense-subtitle'>{label_ru(key)}</div>"))
+                    frames.append(("node", value, lvl + 1, key))
+                elif isinstance(value, list):
+                    if key == "dosage":
+                        frames.append(
+                            ("html", "<hr style='border:none; border-top:1px solid #e5e7eb; margin:6px 0 8px 0;'>")
+                        )
+                    frames.append(("html", f"<div class='dense-subtitle'>{label_ru(key)}</div>"))
+                    if not value:
+                        frames.append(("html", "<div class='dense-line' style='opacity:.6;'>Пусто</div>"))
                         continue
-                    st.markdown(
-                        f"<div class='dense-subtitle'>{label_ru(key)}</div>",
-                        unsafe_allow_html=True,
-                    )
-                render_structured(value, level + 1, key)
-            elif isinstance(value, list):
-                if key == "dosage":
-                    st.markdown(
-                        "<hr style='border:none; border-top:1px solid #e5e7eb; margin:6px 0 8px 0;'>",
-                        unsafe_allow_html=True,
-                    )
-                st.markdown(
-                    f"<div class='dense-subtitle'>{label_ru(key)}</div>",
-                    unsafe_allow_html=True,
-                )
-                if not value:
-                    st.caption("Пусто")
-                    continue
-                for idx, item in enumerate(value, start=1):
-                    if isinstance(item, (dict, list)):
-                        open_block(f"Схема {idx}")
-                        render_structured(item, level + 1, key)
-                        close_block()
-                    else:
-                        st.markdown(f"- {item}")
-            else:
-                render_scalar_line(key, value)
-    elif isinstance(data, list):
-        for idx, item in enumerate(data, start=1):
-            open_block(f"Схема {idx}")
-            render_structured(item, level + 1, parent_key)
-            close_block()
-    else:
-        st.write(data)
-
-
+                    in_list = False
+                    for idx, item in enumerate(value, start=1):
+                        if isinstance(item, (dict, list)):
+                            if in_list:
+                                frames.append(("html", "</ul>"))
+                                in_list = False
+                            frames.append(("html", open_block(f"Схема {idx}")))
+                            frames.append(("node", item, lvl + 1, key))
+                            frames.append(("html", close_block()))
+                        else:
+                            if not in_list:
+                                frames.append(("html", "<ul>"))
+                                in_list = True
+                            frames.append(("html", f"<li>{item}</li>"))
+                    if in_list:
+                        frames.append(("html", "</ul>"))
+                else:
+                    frames.append(("html", render_scalar_line(key, value)))
+        elif isinstance(node, list):
+            for idx, item in enumerate(node, start=1):
+                frames.append(("html", open_block(f"Схема {idx}")))
+                frames.append(("node", item, lvl + 1, pk))
+                frames.append(("html", close_block()))
+        else:
+            buf.append(f"<div class='dense-line'>{node}</div>")
+            continue
+        stack.extend(reversed(frames))
+
+
+@functools.lru_cache(maxsize=8)
 def resolve_bin(name: str) -> str:
     found = shutil.which(name)
     if found:
@@ -225,52 +258,55 @@ def resolve_bin(name: str) -> str:
     return name
 
 
-@st.cache_data(show_spinner=False)
-def find_section_page(pdf_path: str, section: str = "4.1") -> int:
-    marker = re.compile(r"\b4[.,]1\b", flags=re.IGNORECASE)
+# The three PDF helpers persist to ~/.streamlit/cache so restarts do not
+# re-render or re-parse; max_entries bounds how large that directory grows.
+@st.cache_data(show_spinner=False, persist="disk", max_entries=256)
+def find_section_page(pdf_path: str, mtime_ns: int, section: str = "4.1") -> int:
     try:
-        proc = subprocess.run(
-            [resolve_bin("pdftotext"), "-layout", pdf_path, "-"],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-        pages = proc.stdout.split("\f")
-        for idx, text in enumerate(pages, start=1):
-            if marker.search(text):
-                return idx
+        with _fitz_lock():
+            doc = _open_doc(pdf_path, mtime_ns)
+            for idx in range(doc.page_count):
+                if _SECTION_41_RE.search(doc.load_page(idx).get_text("text")):
+                    return idx + 1
     except Exception:
         return 1
     return 1
 
 
-@st.cache_data(show_spinner=False)
-def render_pdf_page_as_image(pdf_path: str, page: int):
-    images = convert_from_path(
-        pdf_path,
-        dpi=120,
-        first_page=page,
-        last_page=page,
-        fmt="png",
-    )
-    return images[0] if images else None
+@st.cache_resource(show_spinner=False)
+def _open_doc(pdf_path: str, mtime_ns: int) -> fitz.Document:
+    # Imported lazily so first paint isn't blocked by the MuPDF bindings;
+    # the cache means this runs once per (path, mtime) anyway.
+    import fitz
 
+    return fitz.open(pdf_path)
 
-@st.cache_data(show_spinner=False)
-def get_pdf_page_count(pdf_path: str) -> int:
+
+@st.cache_data(show_spinner=False, persist="disk", max_entries=256)
+def render_pdf_page_as_image(pdf_path: str, page: int, mtime_ns: int) -> bytes | None:
+    import fitz
+    from PIL import Image
+
+    with _fitz_lock():
+        doc = _open_doc(pdf_path, mtime_ns)
+        if not 1 <= page <= doc.page_count:
+            return None
+        pix = doc.load_page(page - 1).get_pixmap(matrix=fitz.Matrix(120 / 72, 120 / 72), alpha=False)
+    img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    # WebP bytes go to the browser as-is; returning a PIL image would make
+    # st.image re-encode the page to PNG on every rerun.
+    out = io.BytesIO()
+    img.save(out, "WEBP", quality=85, method=4)
+    return out.getvalue()
+
+
+@st.cache_data(show_spinner=False, persist="disk", max_entries=256)
+def get_pdf_page_count(pdf_path: str, mtime_ns: int) -> int:
     try:
-        proc = subprocess.run(
-            [resolve_bin("pdfinfo"), pdf_path],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-        for line in proc.stdout.splitlines():
-            if line.lower().startswith("pages:"):
-                return max(1, int(line.split(":", 1)[1].strip()))
+        with _fitz_lock():
+            return max(1, _open_doc(pdf_path, mtime_ns).page_count)
     except Exception:
         return 1
-    return 1
 
 
 def render_page_control(total_pages: int, page_state_key: str, key_prefix: str, show_label: bool = True) -> None:
@@ -285,19 +321,36 @@ def render_page_control(total_pages: int, page_state_key: str, key_prefix: str,
         if st.button("Вперед →", key=f"{key_prefix}_next", use_container_width=True):
             page = min(total_pages, page + 1)
 
-    st.session_state[page_state_key] = min(max(int(page), 1), total_pages)
+    st.session_state[page_state_key] = 1 if page < 1 else total_pages if page > total_pages else page
+
+
+def _prepare_pdf(pdf_path: str, page_hint: int | None) -> tuple[int, int, bytes | None]:
+    """Warm the PDF caches; safe to run off the main thread."""
+    try:
+        mtime_ns = Path(pdf_path).stat().st_mtime_ns
+        total_pages = get_pdf_page_count(pdf_path, mtime_ns)
+        # Locate section 4.1 only on the first render of a drug; after that
+        # the session already holds the page the user navigated to.
+        page = page_hint if page_hint is not None else find_section_page(pdf_path, mtime_ns, "4.1")
+        page = min(max(int(page), 1), total_pages)
+        image = render_pdf_page_as_image(pdf_path, page, mtime_ns)
+        return total_pages, page, image
+    except Exception:
+        # Unreadable PDF: report one page and no image so render_pdf can
+        # fall through to the warning and the fallback link.
+        return 1, 1, None
 
 
-def render_pdf(pdf_path: Path, state_key: str) -> None:
+def render_pdf(pdf_path: Path, state_key: str, prepared: Future | None = None) -> None:
     if not pdf_path.exists():
         st.error(f"PDF не найден: `{pdf_path}`")
         return
 
-    total_pages = get_pdf_page_count(str(pdf_path))
-    start_page = find_section_page(str(pdf_path), "4.1")
-    start_page = min(max(start_page, 1), total_pages)
-
     page_state_key = f"pdf_page_{state_key}"
+    if prepared is None:
+        prepared = _executor().submit(_prepare_pdf, str(pdf_path), st.session_state.get(page_state_key))
+    total_pages, start_page, _ = prepared.result()
+
     if page_state_key not in st.session_state:
         st.session_state[page_state_key] = start_page
 
@@ -305,7 +358,8 @@ def render_pdf(pdf_path: Path, state_key: str) -> None:
 
     current_page = int(st.session_state[page_state_key])
     try:
-        img = render_pdf_page_as_image(str(pdf_path), current_page)
+        mtime_ns = pdf_path.stat().st_mtime_ns
+        img = render_pdf_page_as_image(str(pdf_path), current_page, mtime_ns)
         if img is not None:
             st.image(
                 img,
@@ -313,6 +367,11 @@ def render_pdf(pdf_path: Path, state_key: str) -> None:
                 caption=f"{pdf_path.name}, страница {current_page}/{total_pages}",
             )
             render_page_control(total_pages, page_state_key, f"bottom_{state_key}", show_label=False)
+            # Warm the neighbouring pages in the background so the next
+            # Next/Prev click is served straight from the cache.
+            for neighbor in (current_page + 1, current_page - 1):
+                if 1 <= neighbor <= total_pages:
+                    _executor().submit(render_pdf_page_as_image, str(pdf_path), neighbor, mtime_ns)
             return
     except Exception:
         pass
@@ -321,14 +380,7 @@ def render_pdf(pdf_path: Path, state_key: str) -> None:
     st.markdown(f"[Открыть PDF-файл]({pdf_path.as_uri()})")
 
 
-def main() -> None:
-    st.set_page_config(
-        page_title="Дозировки: просмотр",
-        layout="wide",
-        initial_sidebar_state="collapsed",
-    )
-    st.markdown(
-        """
+_CSS = """
         <style>
         /* Hide/transparent Streamlit top chrome (Deploy header) */
         [data-testid="stHeader"] {
@@ -469,9 +521,22 @@ def main() -> None:
             margin-bottom: 0.04rem;
         }
         </style>
-        """,
-        unsafe_allow_html=True,
+"""
+
+
+def _inject_css() -> None:
+    # Rerun-level dedupe is handled by Streamlit's forward-message cache;
+    # gating on session_state would drop the styles when the DOM rebuilds.
+    st.markdown(_CSS, unsafe_allow_html=True)
+
+
+def main() -> None:
+    st.set_page_config(
+        page_title="Дозировки: просмотр",
+        layout="wide",
+        initial_sidebar_state="collapsed",
     )
+    _inject_css()
 
     files = list_result_files()
     if not files:
@@ -480,8 +545,14 @@ def main() -> None:
 
     selected = st.selectbox("Препарат", files, key="top_drug_select")
 
+    state_key = Path(selected).stem
     result_path = RESULTS_DIR / selected
-    pdf_path = PDF_DIR / f"{Path(selected).stem}.pdf"
+    pdf_path = PDF_DIR / f"{state_key}.pdf"
+
+    # Kick off PDF work now so MuPDF renders while the left panel paints.
+    pdf_fut: Future | None = None
+    if pdf_path.exists():
+        pdf_fut = _executor().submit(_prepare_pdf, str(pdf_path), st.session_state.get(f"pdf_page_{state_key}"))
 
     st.markdown('<div id="two-col-marker" style="display:none;height:0;margin:0;padding:0;"></div>', unsafe_allow_html=True)
     left, middle, right = st.columns([0.78, 0.02, 1.2], gap="small")
@@ -492,7 +563,9 @@ def main() -> None:
         with left_panel:
             if result_path.exists():
                 result_data = load_json(str(result_path))
-                render_structured(result_data)
+                buf: list[str] = []
+                render_structured(result_data, buf)
+                st.markdown("".join(buf), unsafe_allow_html=True)
             else:
                 st.error(f"Файл не найден: `{result_path}`")
 
@@ -506,7 +579,7 @@ def main() -> None:
         st.subheader("Оригинал")
         right_panel = st.container(height=820, border=False)
         with right_panel:
-            render_pdf(pdf_path, state_key=Path(selected).stem)
+            render_pdf(pdf_path, state_key=state_key, prepared=pdf_fut)
 
 
 if __name__ == "__main__":